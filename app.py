@@ -1,39 +1,133 @@
 import streamlit as st
 import os
+import math
+import functools
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import zipfile
 import tempfile
 import pandas as pd
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import face_recognition
+import dlib
 import io
+import hashlib
 import shutil
 from pathlib import Path
-import base64
 import cv2
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    # PyTurboJPEG or the libjpeg-turbo library is not installed; Pillow is used instead
+    turbo_jpeg = None
+
 st.set_page_config(
     page_title="Profile Picture Generator",
     page_icon="🖼️",
     layout="wide"
 )
 
+# OpenCV res10 SSD face detector, used instead of dlib's HOG detector when both files
+# are present in the assets folder
+FACE_DETECTOR_PROTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                   "assets", "deploy.prototxt")
+FACE_DETECTOR_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                   "assets", "res10_300x300_ssd_iter_140000.caffemodel")
+
+# Longest side of the image passed to dlib's HOG face detector
+DETECTION_MAX_SIZE = 640
+
+@functools.lru_cache(maxsize=8)
+def get_rounded_mask(size, radius):
+    """Build a rounded rectangle mask, or an ellipse if radius is at least half the size.
+    
+    Masks are cached, since size and radius stay the same for every image in a run.
+    """
+    width, height = size
+    
+    # Distance of each pixel center from the center of the mask
+    x = np.arange(width) + 0.5 - width / 2
+    y = (np.arange(height) + 0.5 - height / 2)[:, np.newaxis]
+    
+    if radius >= min(width, height) // 2:  # Ellipse
+        inside = (x / (width / 2)) ** 2 + (y / (height / 2)) ** 2 <= 1
+    else:  # Rounded rectangle: within radius of the nearest corner circle center
+        dx = np.maximum(np.abs(x) - (width / 2 - radius), 0)
+        dy = np.maximum(np.abs(y) - (height / 2 - radius), 0)
+        inside = dx ** 2 + dy ** 2 <= radius ** 2
+    
+    return Image.fromarray(inside.astype(np.uint8) * 255)
+
 def apply_circular_mask(img, radius):
     """Apply a circular mask to the image."""
-    width, height = img.size
-    mask = Image.new('L', (width, height), 0)
-    draw = ImageDraw.Draw(mask)
-    draw.ellipse((0, 0, width, height), fill=255)
+    mask = get_rounded_mask(img.size, max(img.size))
     
     result = img.copy()
     result.putalpha(mask)
     
     return result
 
-def get_face_location(image_path):
-    """Detect face in an image and return the face location."""
-    # Load the image using face_recognition
-    img = face_recognition.load_image_file(image_path)
+@st.cache_resource
+def get_face_detector(pid):
+    """Load the OpenCV DNN face detector, or return None if its model files are missing.
+    
+    Cached as a Streamlit resource so the model is loaded once per process and survives
+    reruns. It is keyed on the process id so forked workers load their own copy instead of
+    inheriting the parent's lock in whatever state it was. Returns (net, lock); the lock
+    serializes use of the network, which is shared between sessions and is not thread-safe.
+    """
+    if not (os.path.exists(FACE_DETECTOR_PROTO) and os.path.exists(FACE_DETECTOR_MODEL)):
+        return None
+    
+    return cv2.dnn.readNetFromCaffe(FACE_DETECTOR_PROTO, FACE_DETECTOR_MODEL), threading.Lock()
+
+def detect_face_dnn(net, img, confidence_threshold=0.5):
+    """Detect the most confident face in an RGB image with the OpenCV DNN face detector."""
+    height, width = img.shape[:2]
+    
+    # The model expects a 300x300 BGR image with the training mean subtracted
+    bgr = cv2.cvtColor(cv2.resize(img, (300, 300)), cv2.COLOR_RGB2BGR)
+    net.setInput(cv2.dnn.blobFromImage(bgr, 1.0, (300, 300), (104, 177, 123)))
+    
+    # Detections have the shape (1, 1, N, 7): [_, _, confidence, left, top, right, bottom]
+    detections = net.forward()[0, 0]
+    if len(detections) == 0:
+        return None
+    
+    best = detections[np.argmax(detections[:, 2])]
+    if best[2] <= confidence_threshold:
+        return None
+    
+    # Box coordinates are relative to the image size
+    left, top, right, bottom = (int(coord) for coord in best[3:7] * [width, height, width, height])
+    return (max(0, top), min(width, right), min(height, bottom), max(0, left))
+
+def get_face_location(image):
+    """Detect face in an image (file path or RGB array) and return the face location."""
+    # Load the image using face_recognition unless it is already decoded
+    if isinstance(image, (str, os.PathLike)):
+        img = face_recognition.load_image_file(image)
+    else:
+        img = image
+    
+    # Prefer the OpenCV DNN detector when its model is available
+    face_detector = get_face_detector(os.getpid())
+    if face_detector is not None:
+        net, lock = face_detector
+        with lock:
+            return detect_face_dnn(net, img)
+    
+    # Downscale large images first, since HOG detection time grows with the pixel count
+    scale = DETECTION_MAX_SIZE / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        scale = 1
     
     # Find all face locations in the image
     face_locations = face_recognition.face_locations(img)
@@ -41,144 +135,343 @@ def get_face_location(image_path):
     if not face_locations:
         return None
     
-    # Return the first face location (assuming one face per image)
-    # Format: (top, right, bottom, left)
-    return face_locations[0]
+    # Return the first face location (assuming one face per image), scaled back to the
+    # original image. Format: (top, right, bottom, left)
+    return tuple(round(coord / scale) for coord in face_locations[0])
 
-def process_image(image_path, name, bbox_size, padding, frame_size, font_size, font_path, 
-                  border_radius, text_color, align_center, top_padding, quality):
-    """Process a single image to create a profile picture with name."""
+def letterbox_image(img, size):
+    """Fit an image into a size x size black square, anchored at the top left.
+    
+    Returns the boxed image and the scale applied to it.
+    """
+    height, width = img.shape[:2]
+    scale = min(1.0, size / max(height, width))
+    if scale < 1:
+        img = cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    boxed = np.zeros((size, size) + img.shape[2:], dtype=img.dtype)
+    boxed[:img.shape[0], :img.shape[1]] = img
+    return boxed, scale
+
+def load_images(image_paths, images_queue, stop_event):
+    """Decode images and put (image_path, image, scale) items on the queue, followed by None.
+    
+    Each image is letterboxed to DETECTION_MAX_SIZE so that any mix of photos can be
+    detected in one batch, and full-resolution photos aren't held in memory. Loading
+    stops early once stop_event is set.
+    """
     try:
-        # Get face location
-        face_location = get_face_location(image_path)
-        
-        if not face_location:
-            st.warning(f"No face detected in {os.path.basename(image_path)}. Skipping...")
-            return None
-        
-        # Extract face coordinates (top, right, bottom, left)
-        top, right, bottom, left = face_location
-        
-        # Calculate center of the face
-        face_center_x = (left + right) // 2
-        face_center_y = (top + bottom) // 2
-        
-        # Calculate the size of the bounding box
-        half_bbox = bbox_size // 2
-        
-        # Calculate the bounding box coordinates with padding
-        bbox_left = max(0, face_center_x - half_bbox - padding)
-        bbox_top = max(0, face_center_y - half_bbox - padding)
-        bbox_right = face_center_x + half_bbox + padding
-        bbox_bottom = face_center_y + half_bbox + padding
-        
-        # Open the image
-        img = Image.open(image_path)
-        
-        # Crop the image to the bounding box
-        cropped_img = img.crop((bbox_left, bbox_top, bbox_right, bbox_bottom))
-        
-        # Resize the cropped image to ensure it fits within the frame
-        cropped_size = min(frame_size[0], frame_size[0])  # Square crop
-        cropped_img = cropped_img.resize((cropped_size, cropped_size), Image.LANCZOS)
-        
-        # Apply border radius if specified
-        if border_radius > 0:
-            # Create a mask for rounded corners
-            mask = Image.new('L', cropped_img.size, 0)
-            draw = ImageDraw.Draw(mask)
-            
-            if border_radius >= cropped_size // 2:  # Circle
-                draw.ellipse((0, 0, cropped_size, cropped_size), fill=255)
-            else:  # Rounded rectangle
-                draw.rounded_rectangle((0, 0, cropped_size, cropped_size), radius=border_radius, fill=255)
-            
-            # Create an empty image with RGBA mode
-            result = Image.new('RGBA', cropped_img.size, (0, 0, 0, 0))
-            
-            # Convert cropped image to RGBA if it's not already
-            if cropped_img.mode != 'RGBA':
-                cropped_img = cropped_img.convert('RGBA')
-            
-            # Apply the mask
-            result.paste(cropped_img, (0, 0), mask)
-            cropped_img = result
-        
-        # Create a new image with the specified frame size
-        frame = Image.new('RGBA', frame_size, (255, 255, 255, 255))
-        
-        # Calculate position to center the cropped image horizontally
-        pos_x = (frame_size[0] - cropped_size) // 2
-        pos_y = top_padding
-        
-        # Paste the cropped image into the frame
-        frame.paste(cropped_img, (pos_x, pos_y), cropped_img if cropped_img.mode == 'RGBA' else None)
-        
-        # Add text to the frame
-        draw = ImageDraw.Draw(frame)
-        
-        # Load font
+        for image_path in image_paths:
+            if stop_event.is_set():
+                break
+            try:
+                img = face_recognition.load_image_file(image_path)
+            except Exception:
+                # Skipped here; the face is then detected, and the error reported, per image
+                continue
+            images_queue.put((image_path,) + letterbox_image(img, DETECTION_MAX_SIZE))
+    finally:
+        images_queue.put(None)
+
+def detect_faces_in_batch(batch, batch_size):
+    """Detect faces in a batch of (image_path, image, scale) items with dlib's CNN detector.
+    
+    The images must all have the same shape; locations are scaled back to the original images.
+    """
+    face_locations = {}
+    
+    batch_locations = face_recognition.batch_face_locations(
+        [img for _, img, _ in batch], number_of_times_to_upsample=0, batch_size=batch_size
+    )
+    for (image_path, _, scale), locations in zip(batch, batch_locations):
+        face_locations[image_path] = (
+            tuple(round(coord / scale) for coord in locations[0]) if locations else None
+        )
+    
+    return face_locations
+
+def detect_all_faces(image_paths, batch_size=128):
+    """Detect faces in all images in batches with dlib's CNN detector (GPU).
+    
+    Returns a dict mapping each image path to its first face location, or None when
+    no face was found. Images that cannot be decoded are left out.
+    """
+    face_locations = {}
+    
+    # Decode images on a loader thread so the next batch is ready while the GPU is busy.
+    # The bounded queue keeps at most about two batches of decoded images in memory
+    images_queue = queue.Queue(maxsize=batch_size)
+    stop_event = threading.Event()
+    loader = threading.Thread(target=load_images, args=(image_paths, images_queue, stop_event), daemon=True)
+    loader.start()
+    
+    try:
+        batch = []
+        for item in iter(images_queue.get, None):
+            batch.append(item)
+            if len(batch) == batch_size:
+                face_locations.update(detect_faces_in_batch(batch, batch_size))
+                batch = []
+        
+        if batch:
+            face_locations.update(detect_faces_in_batch(batch, batch_size))
+    finally:
+        # If detection failed, stop the loader and drain the queue so that it isn't left
+        # blocked on a full queue, holding decoded images
+        stop_event.set()
+        while loader.is_alive():
+            try:
+                images_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        loader.join()
+    
+    return face_locations
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_path, font_size):
+    """Load a font, cached so that it is only parsed once per font file and size."""
+    if font_path:
         try:
-            font = ImageFont.truetype(font_path, font_size)
+            return ImageFont.truetype(font_path, font_size)
         except IOError:
-            # Fallback to default font
-            font = ImageFont.load_default()
-        
-        # Calculate text width and split into multiple lines if necessary
-        text_y = pos_y + cropped_size + 10
-        
-        # Function to wrap text
-        def get_wrapped_text(text, font, max_width):
-            lines = []
-            words = text.split()
-            current_line = words[0]
-            
-            for word in words[1:]:
-                # Check if adding this word exceeds the max width
-                test_line = current_line + " " + word
-                test_width = font.getlength(test_line)
-                
-                if test_width <= max_width:
-                    current_line = test_line
-                else:
-                    lines.append(current_line)
-                    current_line = word
-            
+            pass
+    
+    # Fallback to default font
+    return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=2048)
+def get_wrapped_text(text, font, max_width):
+    """Split text into lines that fit within max_width, cached per (text, font, max_width)."""
+    lines = []
+    words = text.split()
+    if not words:
+        return ()
+    
+    # Measure each word once and add up widths instead of measuring every candidate line
+    space_width = font.getlength(" ")
+    word_widths = [font.getlength(word) for word in words]
+    
+    current_line = words[0]
+    current_width = word_widths[0]
+    
+    for word, word_width in zip(words[1:], word_widths[1:]):
+        # Check if adding this word exceeds the max width
+        test_width = current_width + space_width + word_width
+        
+        if test_width <= max_width:
+            current_line = current_line + " " + word
+            current_width = test_width
+        else:
             lines.append(current_line)
-            return lines
-        
-        # Get wrapped text lines
-        wrapped_lines = get_wrapped_text(name, font, frame_size[0] - 20)
-        
-        # Draw each line of text
-        for i, line in enumerate(wrapped_lines):
-            if align_center:
-                text_width = font.getlength(line)
-                text_x = (frame_size[0] - text_width) // 2
-            else:
-                text_x = 10
-            
-            draw.text((text_x, text_y + i * (font_size + 5)), line, fill=text_color, font=font)
-        
-        # Convert to RGB before saving as JPEG
-        frame_rgb = frame.convert('RGB')
-        
-        # Save to an in-memory file
-        output = io.BytesIO()
-        frame_rgb.save(output, format='JPEG', quality=quality)
-        output.seek(0)
-        
-        return output
+            current_line = word
+            current_width = word_width
     
-    except Exception as e:
-        st.error(f"Error processing {os.path.basename(image_path)}: {str(e)}")
+    lines.append(current_line)
+    return tuple(lines)
+
+def encode_jpeg(img, quality):
+    """Encode an RGB image as JPEG into an in-memory file."""
+    # libjpeg-turbo's SIMD encoder is faster than Pillow's; 4:2:0 matches Pillow's output
+    if turbo_jpeg is not None:
+        return io.BytesIO(turbo_jpeg.encode(np.asarray(img), quality=quality, 
+                                            pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420))
+    
+    # Save to an in-memory file
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality)
+    output.seek(0)
+    
+    return output
+
+def process_image(image_path, name, bbox_size, padding, frame_size, font_size, font_path, 
+                  border_radius, text_color, align_center, top_padding, quality, face_location=None):
+    """Process a single image to create a profile picture with name.
+    
+    face_location is given in original image coordinates; if it is not given, the face is
+    detected in the image. Returns None when no face is detected. Errors are raised to the
+    caller so that this function can run in a worker process without touching the Streamlit UI.
+    """
+    # Open the image once; the same decoded pixels are used for face detection and cropping
+    img = Image.open(image_path)
+    original_width = img.width
+    
+    # Size of the cropped image inside the frame
+    cropped_size = min(frame_size[0], frame_size[0])  # Square crop
+    
+    # Let the JPEG decoder scale the image down by 1/2, 1/4 or 1/8 as long as the
+    # bounding box still covers at least cropped_size pixels (no-op for other formats)
+    reduction = (bbox_size + 2 * padding) / cropped_size
+    if face_location is None and get_face_detector(os.getpid()) is None:
+        # The face is detected in the decoded image, and dlib's HOG detector misses faces
+        # smaller than about 80 pixels, so keep at least DETECTION_MAX_SIZE on the long side
+        reduction = min(reduction, max(img.size) / DETECTION_MAX_SIZE)
+    if reduction > 1:
+        img.draft(img.mode, (math.ceil(img.width / reduction), math.ceil(img.height / reduction)))
+    img.load()
+    
+    # From here on the picture is a single HWC uint8 array: the face detector reads it and
+    # the crop is a view into it, so no further copies of the full image are made
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode.endswith('A') or 'transparency' in img.info else 'RGB')
+    pixels = np.asarray(img)
+    
+    # Scale from the original image to the decoded image
+    scale = img.width / original_width
+    
+    # Get face location in the coordinates of the decoded image
+    if face_location is None:
+        if img.mode == 'RGB':
+            rgb_pixels = pixels
+        else:
+            rgb_pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2RGB if img.mode == 'RGBA' else cv2.COLOR_GRAY2RGB)
+        face_location = get_face_location(rgb_pixels)
+    else:
+        face_location = tuple(round(coord * scale) for coord in face_location)
+    
+    if not face_location:
         return None
+    
+    # Extract face coordinates (top, right, bottom, left)
+    top, right, bottom, left = face_location
+    
+    # Calculate center of the face
+    face_center_x = (left + right) // 2
+    face_center_y = (top + bottom) // 2
+    
+    # Calculate the size of the bounding box and padding in the decoded image
+    half_bbox = round(bbox_size * scale) // 2
+    scaled_padding = round(padding * scale)
+    
+    # Calculate the bounding box coordinates with padding
+    bbox_left = max(0, face_center_x - half_bbox - scaled_padding)
+    bbox_top = max(0, face_center_y - half_bbox - scaled_padding)
+    bbox_right = face_center_x + half_bbox + scaled_padding
+    bbox_bottom = face_center_y + half_bbox + scaled_padding
+    
+    # Crop the image to the bounding box, padding a box that runs past the right/bottom
+    # edge with black
+    region = pixels[bbox_top:bbox_bottom, bbox_left:bbox_right]
+    pad_bottom = (bbox_bottom - bbox_top) - region.shape[0]
+    pad_right = (bbox_right - bbox_left) - region.shape[1]
+    if pad_bottom or pad_right:
+        region = cv2.copyMakeBorder(region, 0, pad_bottom, 0, pad_right, cv2.BORDER_CONSTANT, value=0)
+    
+    # Resize the cropped image to the frame width. When shrinking, OpenCV's area
+    # interpolation is much faster than Pillow's LANCZOS and looks about the same, but it
+    # is blurrier when enlarging, so Pillow is kept for that
+    if min(region.shape[:2]) > cropped_size:
+        cropped_img = Image.fromarray(cv2.resize(region, (cropped_size, cropped_size), 
+                                                 interpolation=cv2.INTER_AREA))
+    else:
+        cropped_img = Image.fromarray(region).resize((cropped_size, cropped_size), Image.LANCZOS)
+    
+    # Create a new image with the specified frame size
+    frame = Image.new('RGB', frame_size, (255, 255, 255))
+    
+    # Calculate position to center the cropped image horizontally
+    pos_x = (frame_size[0] - cropped_size) // 2
+    pos_y = top_padding
+    
+    # Transparent parts of the picture are left white: its own alpha channel, if any,
+    # and the corners cut off by the border radius
+    mask = cropped_img.getchannel('A') if cropped_img.mode == 'RGBA' else None
+    if border_radius > 0:
+        rounded_mask = get_rounded_mask(cropped_img.size, border_radius)
+        mask = rounded_mask if mask is None else ImageChops.multiply(mask, rounded_mask)
+    
+    # Paste the cropped image into the frame
+    frame.paste(cropped_img, (pos_x, pos_y), mask)
+    
+    # Add text to the frame
+    draw = ImageDraw.Draw(frame)
+    
+    # Load font
+    font = load_font(font_path, font_size)
+    
+    # Calculate text width and split into multiple lines if necessary
+    text_y = pos_y + cropped_size + 10
+    
+    # Get wrapped text lines
+    wrapped_lines = get_wrapped_text(name, font, frame_size[0] - 20)
+    
+    # Draw each line of text
+    for i, line in enumerate(wrapped_lines):
+        if align_center:
+            text_width = font.getlength(line)
+            text_x = (frame_size[0] - text_width) // 2
+        else:
+            text_x = 10
+        
+        draw.text((text_x, text_y + i * (font_size + 5)), line, fill=text_color, font=font)
+    
+    return encode_jpeg(frame, quality)
 
-def create_download_link(file_content, filename):
-    """Create a download link for a file."""
-    b64 = base64.b64encode(file_content).decode()
-    href = f'<a href="data:application/zip;base64,{b64}" download="{filename}">Download Processed Images</a>'
-    return href
+def init_worker():
+    """Set up a worker process for process_job."""
+    # Each worker handles one image at a time; OpenCV's own thread pool in every worker
+    # would oversubscribe the CPU
+    cv2.setNumThreads(1)
+
+def process_job(job):
+    """Run process_image for one (image_path, name, params, face_location) job and capture any error.
+    
+    Returns a tuple of (processed image or None, error message or None).
+    """
+    image_path, name, params, face_location = job
+    try:
+        return process_image(image_path, name, *params, face_location=face_location), None
+    except Exception as e:
+        return None, f"Error processing {os.path.basename(image_path)}: {str(e)}"
+
+@st.cache_resource(max_entries=4, validate=lambda result: os.path.isdir(result[0].name))
+def extract_zip(zip_bytes):
+    """Extract an uploaded ZIP file into a new temporary directory and find its files.
+    
+    Cached on the ZIP contents, since Streamlit reruns the whole script on every widget
+    change. Returns (temp_dir, csv_files, image_files), with the image files sorted to
+    match the CSV order if possible. temp_dir is a TemporaryDirectory, removed once the
+    entry has left the cache and no run holds it; it is shared by all sessions, so it is
+    read-only. An entry whose directory is gone from disk is extracted again.
+    """
+    temp_dir = tempfile.TemporaryDirectory()
+    
+    # Extract ZIP file
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as zip_ref:
+        zip_ref.extractall(temp_dir.name)
+    
+    # Try to find the CSV file
+    csv_files = list(Path(temp_dir.name).glob('**/*.csv'))
+    
+    # Find image files
+    image_files = []
+    for ext in ['jpg', 'jpeg', 'png']:
+        image_files.extend(list(Path(temp_dir.name).glob(f'**/*.{ext}')))
+        image_files.extend(list(Path(temp_dir.name).glob(f'**/*.{ext.upper()}')))
+    
+    # Sort image files to match CSV order if possible
+    try:
+        image_files.sort(key=lambda x: int(x.stem))
+    except:
+        # If images can't be sorted numerically, use alphabetical sort
+        image_files.sort()
+    
+    return temp_dir, csv_files, image_files
+
+def save_font(font_bytes, suffix):
+    """Save an uploaded font to a temporary file named after its contents and return its path.
+    
+    Sessions that upload the same font share the file, and a file is never overwritten
+    with a different font while another run reads it.
+    """
+    font_path = os.path.join(tempfile.gettempdir(), 
+                             f"profile_font_{hashlib.sha256(font_bytes).hexdigest()}{suffix}")
+    if not os.path.exists(font_path):
+        # Write to another file first so that a run never reads a partly written font
+        fd, temp_path = tempfile.mkstemp(suffix=suffix, dir=os.path.dirname(font_path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(font_bytes)
+        os.replace(temp_path, font_path)
+    return font_path
 
 def main():
     st.title("Automated Profile Picture Generator")
@@ -263,145 +556,151 @@ def main():
         if uploaded_zip is not None:
             st.subheader("Processing")
             
-            # Create temporary directory
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Extract ZIP file
-                with zipfile.ZipFile(uploaded_zip, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
-                
-                # Try to find the CSV file
-                csv_files = list(Path(temp_dir).glob('**/*.csv'))
+            # Extract the ZIP file (cached, so changing a setting doesn't extract it again)
+            # temp_dir is held for the rest of the run so that the files stay on disk
+            temp_dir, csv_files, image_files = extract_zip(uploaded_zip.getvalue())
+            
+            if not csv_files:
+                st.error("No CSV file found in the uploaded ZIP. Please include a CSV file with names.")
+            else:
+                # Use the first CSV file found
+                csv_file = csv_files[0]
                 
-                if not csv_files:
-                    st.error("No CSV file found in the uploaded ZIP. Please include a CSV file with names.")
-                else:
-                    # Use the first CSV file found
-                    csv_file = csv_files[0]
+                # Try to read the CSV file
+                try:
+                    df = pd.read_csv(csv_file)
                     
-                    # Try to read the CSV file
-                    try:
-                        df = pd.read_csv(csv_file)
+                    # Check if the CSV has at least one column
+                    if df.shape[1] < 1:
+                        st.error("CSV file doesn't have any columns. Please include a column with names.")
+                    else:
+                        # Use the first column for names
+                        names_column = df.iloc[:, 0]
                         
-                        # Check if the CSV has at least one column
-                        if df.shape[1] < 1:
-                            st.error("CSV file doesn't have any columns. Please include a column with names.")
+                        if not image_files:
+                            st.error("No image files found in the uploaded ZIP. Please include images.")
                         else:
-                            # Use the first column for names
-                            names_column = df.iloc[:, 0]
+                            # Handle font file
+                            font_path = None
+                            if uploaded_font is not None:
+                                font_path = save_font(uploaded_font.getvalue(), 
+                                                      os.path.splitext(uploaded_font.name)[1])
+                            else:
+                                # Use default font
+                                font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                                    "assets", "arial.ttf")
+                                if not os.path.exists(font_path):
+                                    # Fallback to system default
+                                    font_path = None
                             
-                            # Find image files
-                            image_files = []
-                            for ext in ['jpg', 'jpeg', 'png']:
-                                image_files.extend(list(Path(temp_dir).glob(f'**/*.{ext}')))
-                                image_files.extend(list(Path(temp_dir).glob(f'**/*.{ext.upper()}')))
+                            # Processing parameters shared by the preview and the batch run
+                            frame_size = (frame_width, frame_height)
+                            params = (bbox_size, padding, frame_size, font_size, font_path,
+                                      border_radius, text_color, align_center, top_padding, quality)
                             
-                            if not image_files:
-                                st.error("No image files found in the uploaded ZIP. Please include images.")
-                            else:
-                                # Sort image files to match CSV order if possible
-                                try:
-                                    image_files.sort(key=lambda x: int(x.stem))
-                                except:
-                                    # If images can't be sorted numerically, use alphabetical sort
-                                    image_files.sort()
-                                
-                                # Handle font file
-                                font_path = None
-                                if uploaded_font is not None:
-                                    font_temp = os.path.join(temp_dir, "custom_font" + 
-                                                        os.path.splitext(uploaded_font.name)[1])
-                                    with open(font_temp, "wb") as f:
-                                        f.write(uploaded_font.getbuffer())
-                                    font_path = font_temp
-                                else:
-                                    # Use default font
-                                    font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
-                                                        "assets", "arial.ttf")
-                                    if not os.path.exists(font_path):
-                                        # Fallback to system default
-                                        font_path = None
-                                
-                                # Sample processing for preview
-                                if st.button("Generate Preview"):
-                                    if len(image_files) > 0 and len(names_column) > 0:
-                                        # Process the first image for preview
-                                        frame_size = (frame_width, frame_height)
-                                        preview_img = process_image(
-                                            str(image_files[0]), 
-                                            names_column[0],
-                                            bbox_size,
-                                            padding,
-                                            frame_size,
-                                            font_size,
-                                            font_path,
-                                            border_radius,
-                                            text_color,
-                                            align_center,
-                                            top_padding,
-                                            quality
-                                        )
-                                        
-                                        if preview_img:
-                                            st.image(preview_img, caption=f"Preview: {names_column[0]}", 
-                                                    use_column_width=True)
-                                        else:
-                                            st.warning("Could not generate preview. Please check your image.")
-                                
-                                # Process all images button
-                                if st.button("Process All Images"):
-                                    progress_bar = st.progress(0)
-                                    status_text = st.empty()
+                            # Sample processing for preview
+                            if st.button("Generate Preview"):
+                                if len(image_files) > 0 and len(names_column) > 0:
+                                    # Process the first image for preview
+                                    preview_img, error = process_job((str(image_files[0]), names_column[0], params, None))
+                                    
+                                    if error:
+                                        st.error(error)
                                     
-                                    # Create a temporary ZIP file to store processed images
-                                    zip_buffer = io.BytesIO()
-                                    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-                                        # Process each image
+                                    if preview_img:
+                                        st.image(preview_img, caption=f"Preview: {names_column[0]}", 
+                                                use_column_width=True)
+                                    else:
+                                        st.warning("Could not generate preview. Please check your image.")
+                            
+                            # Process all images button
+                            if st.button("Process All Images"):
+                                progress_bar = st.progress(0)
+                                status_text = st.empty()
+                                
+                                # Write processed images to a temporary ZIP file on disk instead of memory.
+                                # The JPEGs are already compressed, so entries are stored without deflate
+                                with tempfile.NamedTemporaryFile(suffix='.zip') as zip_tmp:
+                                    with zipfile.ZipFile(zip_tmp, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+                                        # Process each image in a separate worker process
                                         total_images = min(len(image_files), len(names_column))
                                         processed_count = 0
                                         
-                                        for i in range(total_images):
-                                            if i < len(image_files) and i < len(names_column):
-                                                status_text.text(f"Processing image {i+1}/{total_images}: {names_column[i]}")
-                                                
-                                                # Process image
-                                                frame_size = (frame_width, frame_height)
-                                                processed_img = process_image(
-                                                    str(image_files[i]), 
-                                                    names_column[i],
-                                                    bbox_size,
-                                                    padding,
-                                                    frame_size,
-                                                    font_size,
-                                                    font_path,
-                                                    border_radius,
-                                                    text_color,
-                                                    align_center,
-                                                    top_padding,
-                                                    quality
+                                        # With a CUDA build of dlib, detect all faces up front in GPU batches
+                                        face_locations = {}
+                                        if dlib.DLIB_USE_CUDA:
+                                            status_text.text("Detecting faces...")
+                                            try:
+                                                face_locations = detect_all_faces(
+                                                    [str(image_file) for image_file in image_files[:total_images]]
                                                 )
+                                            except Exception as e:
+                                                # Fall back to detecting each face in the workers
+                                                st.warning(f"Batch face detection failed, detecting faces per image instead: {str(e)}")
+                                                face_locations = {}
+                                        
+                                        # Update the status and progress bar about 100 times in total rather than
+                                        # once per image, since each update is a message to the browser
+                                        update_every = max(1, total_images // 100)
+                                        names = names_column.tolist()
+                                        
+                                        done = 0
+                                        pool_failed = False
+                                        executor = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker)
+                                        try:
+                                            futures = {}
+                                            for i in range(total_images):
+                                                image_path = str(image_files[i])
+                                                if image_path in face_locations and face_locations[image_path] is None:
+                                                    st.warning(f"No face detected in {image_files[i].name}. Skipping...")
+                                                    done += 1
+                                                    continue
                                                 
-                                                if processed_img:
-                                                    # Add to ZIP
-                                                    zip_file.writestr(
-                                                        f"{i+1:02d}.jpg", 
-                                                        processed_img.getvalue()
-                                                    )
-                                                    processed_count += 1
-                                                
-                                                # Update progress
-                                                progress_bar.progress((i + 1) / total_images)
+                                                job = (image_path, names[i], params, face_locations.get(image_path))
+                                                futures[executor.submit(process_job, job)] = i
+                                            
+                                            # UI updates and ZIP writes stay in the main process
+                                            try:
+                                                for future in as_completed(futures):
+                                                    i = futures[future]
+                                                    processed_img, error = future.result()
+                                                    done += 1
+                                                    
+                                                    if error:
+                                                        st.error(error)
+                                                    elif processed_img:
+                                                        # Add to ZIP
+                                                        zip_file.writestr(
+                                                            f"{i+1:02d}.jpg", 
+                                                            processed_img.getvalue()
+                                                        )
+                                                        processed_count += 1
+                                                    else:
+                                                        st.warning(f"No face detected in {image_files[i].name}. Skipping...")
+                                                    
+                                                    # Update progress
+                                                    if done % update_every == 0 or done == total_images:
+                                                        status_text.text(f"Processed image {done}/{total_images}: {names[i]}")
+                                                        progress_bar.progress(done / total_images)
+                                            except BrokenProcessPool as e:
+                                                pool_failed = True
+                                                st.error(f"Processing failed: a worker process stopped unexpectedly ({str(e)})")
+                                        finally:
+                                            # Don't wait for queued images when the run is stopped or fails
+                                            executor.shutdown(wait=False, cancel_futures=True)
                                         
                                         status_text.text(f"Processing complete! {processed_count}/{total_images} images processed.")
                                     
-                                    # Provide download link
-                                    zip_buffer.seek(0)
-                                    st.success("All images processed successfully!")
-                                    st.markdown(create_download_link(zip_buffer.getvalue(), "processed_images.zip"), 
-                                            unsafe_allow_html=True)
-                                    
-                    except Exception as e:
-                        st.error(f"Error reading CSV file: {str(e)}")
-    
+                                    # Provide download button
+                                    zip_tmp.seek(0)
+                                    if not pool_failed:
+                                        st.success("All images processed successfully!")
+                                    st.download_button("Download Processed Images", data=zip_tmp.read(), 
+                                                       file_name="processed_images.zip", mime="application/zip")
+                                
+                except Exception as e:
+                    st.error(f"Error reading CSV file: {str(e)}")
+
     # Instructions and FAQ
     st.subheader("Instructions & FAQ")
     
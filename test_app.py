@@ -3,17 +3,20 @@ import sys
 import unittest
 from unittest.mock import patch, MagicMock
 import tempfile
+import shutil
+import threading
 import zipfile
 import pandas as pd
-from PIL import Image
+from PIL import Image, JpegImagePlugin
 import numpy as np
+import cv2
 import io
 
 # Add the parent directory to the path so we can import app.py
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import functions from app.py
-from app import get_face_location, apply_circular_mask, process_image
+from app import get_face_location, detect_face_dnn, detect_all_faces, get_rounded_mask, apply_circular_mask, load_font, get_wrapped_text, encode_jpeg, process_image, process_job, extract_zip, save_font
 
 class TestProfilePictureGenerator(unittest.TestCase):
     
@@ -59,6 +62,124 @@ class TestProfilePictureGenerator(unittest.TestCase):
         mock_face_recognition.face_locations.return_value = []
         result = get_face_location(self.test_image_path)
         self.assertIsNone(result)
+        
+        # Test with an already decoded image: the file is not loaded again
+        mock_face_recognition.load_image_file.reset_mock()
+        mock_face_recognition.face_locations.return_value = [(10, 60, 70, 20)]
+        result = get_face_location(np.zeros((100, 100, 3), dtype=np.uint8))
+        self.assertEqual(result, (10, 60, 70, 20))
+        mock_face_recognition.load_image_file.assert_not_called()
+        
+        # Test that large images are downscaled before detection
+        mock_face_recognition.face_locations.return_value = [(10, 60, 70, 20)]
+        result = get_face_location(np.zeros((960, 1280, 3), dtype=np.uint8))
+        self.assertEqual(mock_face_recognition.face_locations.call_args[0][0].shape, (480, 640, 3))
+        self.assertEqual(result, (20, 120, 140, 40))
+    
+    @patch('app.detect_face_dnn')
+    @patch('app.get_face_detector')
+    @patch('app.face_recognition')
+    def test_get_face_location_dnn(self, mock_face_recognition, mock_get_face_detector, mock_detect_face_dnn):
+        """Test that get_face_location uses the OpenCV DNN detector when it is available."""
+        mock_net = MagicMock()
+        mock_get_face_detector.return_value = (mock_net, threading.Lock())
+        mock_detect_face_dnn.return_value = (10, 60, 70, 20)
+        img = np.zeros((100, 100, 3), dtype=np.uint8)
+        
+        result = get_face_location(img)
+        
+        self.assertEqual(result, (10, 60, 70, 20))
+        mock_detect_face_dnn.assert_called_once_with(mock_net, img)
+        mock_face_recognition.face_locations.assert_not_called()
+    
+    def test_detect_face_dnn(self):
+        """Test the detect_face_dnn function."""
+        # Mock the network to return two detections with relative box coordinates
+        mock_net = MagicMock()
+        mock_net.forward.return_value = np.array([[[
+            [0, 1, 0.3, 0.0, 0.0, 0.5, 0.5],
+            [0, 1, 0.9, 0.2, 0.1, 0.6, 0.7],
+        ]]])
+        img = np.zeros((100, 200, 3), dtype=np.uint8)
+        
+        # The most confident detection is returned as (top, right, bottom, left)
+        result = detect_face_dnn(mock_net, img)
+        self.assertEqual(result, (10, 120, 70, 40))
+        
+        # Test when no detection is confident enough
+        mock_net.forward.return_value = np.array([[[[0, 1, 0.3, 0.0, 0.0, 0.5, 0.5]]]])
+        result = detect_face_dnn(mock_net, img)
+        self.assertIsNone(result)
+    
+    @patch('app.face_recognition')
+    def test_detect_all_faces(self, mock_face_recognition):
+        """Test the detect_all_faces function."""
+        # Images of different sizes; only the bright ones contain a face
+        images = {
+            "a.jpg": np.full((1280, 960, 3), 255, dtype=np.uint8),
+            "b.jpg": np.full((100, 100, 3), 255, dtype=np.uint8),
+            "c.jpg": np.zeros((80, 60, 3), dtype=np.uint8),
+        }
+        mock_face_recognition.load_image_file.side_effect = lambda path: images[path]
+        mock_face_recognition.batch_face_locations.side_effect = lambda images, **kwargs: [
+            [(10, 60, 70, 20)] if img[0, 0, 0] else [] for img in images
+        ]
+        
+        # Call the function
+        result = detect_all_faces(["a.jpg", "b.jpg", "c.jpg"])
+        
+        # Locations are scaled back to the original images
+        self.assertEqual(result, {"a.jpg": (20, 120, 140, 40), "b.jpg": (10, 60, 70, 20), "c.jpg": None})
+        
+        # All images are letterboxed to one shape and detected in a single batch
+        mock_face_recognition.batch_face_locations.assert_called_once()
+        batch = mock_face_recognition.batch_face_locations.call_args.args[0]
+        self.assertEqual([img.shape for img in batch], [(640, 640, 3)] * 3)
+        
+        # Images that cannot be decoded are left out
+        def load_image_file(path):
+            if path == "b.jpg":
+                raise OSError("cannot identify image file")
+            return images[path]
+        
+        mock_face_recognition.load_image_file.side_effect = load_image_file
+        result = detect_all_faces(["a.jpg", "b.jpg", "c.jpg"], batch_size=1)
+        self.assertEqual(result, {"a.jpg": (20, 120, 140, 40), "c.jpg": None})
+        
+        # When detection fails, the error is raised and the loader thread stops
+        loaders = []
+        thread_class = threading.Thread
+        def create_thread(*args, **kwargs):
+            loaders.append(thread_class(*args, **kwargs))
+            return loaders[-1]
+        
+        mock_face_recognition.load_image_file.reset_mock()
+        mock_face_recognition.load_image_file.side_effect = lambda path: images["a.jpg"]
+        mock_face_recognition.batch_face_locations.side_effect = RuntimeError("CUDA out of memory")
+        with patch('app.threading.Thread', side_effect=create_thread):
+            with self.assertRaises(RuntimeError):
+                detect_all_faces([f"{i}.jpg" for i in range(10)], batch_size=1)
+        self.assertEqual(len(loaders), 1)
+        self.assertFalse(loaders[0].is_alive())
+        self.assertLess(mock_face_recognition.load_image_file.call_count, 10)
+    
+    def test_get_rounded_mask(self):
+        """Test the get_rounded_mask function."""
+        # Rounded rectangle: corners are masked out, edges and center are kept
+        mask = np.asarray(get_rounded_mask((100, 100), 20))
+        self.assertEqual(mask.shape, (100, 100))
+        self.assertEqual(mask[0, 0], 0)
+        self.assertEqual(mask[0, 50], 255)
+        self.assertEqual(mask[50, 0], 255)
+        self.assertEqual(mask[50, 50], 255)
+        
+        # Circle: the edge midpoints are kept, points just inside the corners are not
+        mask = np.asarray(get_rounded_mask((100, 100), 50))
+        self.assertEqual(mask[50, 0], 255)
+        self.assertEqual(mask[10, 10], 0)
+        
+        # Masks are reused for the same size and radius
+        self.assertIs(get_rounded_mask((100, 100), 20), get_rounded_mask((100, 100), 20))
     
     def test_apply_circular_mask(self):
         """Test the apply_circular_mask function."""
@@ -75,8 +196,9 @@ class TestProfilePictureGenerator(unittest.TestCase):
         self.assertEqual(result.size, (100, 100))
     
     @patch('app.get_face_location')
+    @patch('app.ImageDraw')
     @patch('app.ImageFont')
-    def test_process_image(self, mock_image_font, mock_get_face_location):
+    def test_process_image(self, mock_image_font, mock_image_draw, mock_get_face_location):
         """Test the process_image function."""
         # Mock face detection
         mock_get_face_location.return_value = (10, 60, 70, 20)  # (top, right, bottom, left)
@@ -85,6 +207,8 @@ class TestProfilePictureGenerator(unittest.TestCase):
         mock_font = MagicMock()
         mock_font.getlength.return_value = 50
         mock_image_font.truetype.return_value = mock_font
+        mock_image_font.load_default.return_value = mock_font
+        load_font.cache_clear()
         
         # Call the function
         result = process_image(
@@ -105,10 +229,20 @@ class TestProfilePictureGenerator(unittest.TestCase):
         # Check that the result is a BytesIO object
         self.assertIsInstance(result, io.BytesIO)
         
+        # Test rounded corners on a black image: the corners of the picture are left white
+        black_image_path = os.path.join(self.temp_dir.name, "black_image.png")
+        Image.new('RGB', (100, 100), color='black').save(black_image_path)
+        result = process_image(black_image_path, "Test Name", 40, 20, (100, 160), 16, None,
+                               50, "#000000", True, 10, 90)
+        output = Image.open(result)
+        self.assertEqual(output.mode, 'RGB')
+        self.assertGreater(output.getpixel((2, 12))[0], 200)  # Corner of the picture
+        self.assertLess(output.getpixel((50, 60))[0], 50)  # Center of the picture
+        
         # Test when no face is detected
         mock_get_face_location.return_value = None
         
-        # This should return None
+        # This should return None without touching the Streamlit UI
         with patch('app.st.warning') as mock_warning:
             result = process_image(
                 self.test_image_path,
@@ -125,7 +259,220 @@ class TestProfilePictureGenerator(unittest.TestCase):
                 90
             )
             self.assertIsNone(result)
-            mock_warning.assert_called_once()
+            mock_warning.assert_not_called()
+    
+    @patch('app.get_face_location')
+    @patch('app.ImageDraw')
+    @patch('app.ImageFont')
+    def test_process_image_crop(self, mock_image_font, mock_image_draw, mock_get_face_location):
+        """Test cropping, padding and resizing in process_image."""
+        mock_font = MagicMock()
+        mock_font.getlength.return_value = 50
+        mock_image_font.load_default.return_value = mock_font
+        load_font.cache_clear()
+        
+        # A large white picture with the face near the bottom right corner: the 400 pixel box
+        # runs 145 pixels past both edges and is shrunk to the 100 pixel picture
+        large_image_path = os.path.join(self.temp_dir.name, "large_image.png")
+        Image.new('RGB', (1000, 800), color='white').save(large_image_path)
+        with patch('app.cv2.resize', wraps=cv2.resize) as mock_resize:
+            result = process_image(large_image_path, "Test Name", 300, 50, (100, 160), 16, None,
+                                   0, "#000000", True, 10, 95, face_location=(700, 990, 790, 900))
+        mock_resize.assert_called_once()
+        self.assertEqual(mock_resize.call_args.kwargs['interpolation'], cv2.INTER_AREA)
+        
+        output = Image.open(result)
+        self.assertEqual(output.size, (100, 160))
+        self.assertEqual(output.mode, 'RGB')
+        self.assertGreater(output.getpixel((30, 40))[0], 200)  # Inside the picture
+        self.assertLess(output.getpixel((90, 40))[0], 50)  # Padding past the right edge
+        self.assertLess(output.getpixel((30, 100))[0], 50)  # Padding past the bottom edge
+        
+        # Pictures in other modes: black, with the left half transparent if there is alpha
+        mock_get_face_location.return_value = (50, 150, 150, 50)
+        for mode in ('L', 'P', 'LA', 'RGBA'):
+            with self.subTest(mode=mode):
+                image = Image.new('RGBA', (200, 200), color=(0, 0, 0, 255))
+                if mode.endswith('A'):
+                    image.paste((0, 0, 0, 0), (0, 0, 100, 200))
+                image_path = os.path.join(self.temp_dir.name, f"image_{mode}.png")
+                image.convert(mode).save(image_path)
+                
+                result = process_image(image_path, "Test Name", 100, 50, (100, 160), 16, None,
+                                       0, "#000000", True, 10, 95)
+                
+                # The face is detected on RGB pixels
+                self.assertEqual(mock_get_face_location.call_args.args[0].shape, (200, 200, 3))
+                
+                output = Image.open(result)
+                self.assertEqual(output.size, (100, 160))
+                self.assertEqual(output.mode, 'RGB')
+                self.assertLess(output.getpixel((80, 60))[0], 50)
+                if mode.endswith('A'):
+                    self.assertGreater(output.getpixel((20, 60))[0], 200)  # Transparent is white
+                else:
+                    self.assertLess(output.getpixel((20, 60))[0], 50)
+    
+    @patch('app.get_face_location')
+    @patch('app.ImageDraw')
+    @patch('app.ImageFont')
+    def test_process_image_draft(self, mock_image_font, mock_image_draw, mock_get_face_location):
+        """Test process_image on a large JPEG that is decoded at reduced size."""
+        mock_font = MagicMock()
+        mock_font.getlength.return_value = 50
+        mock_image_font.load_default.return_value = mock_font
+        load_font.cache_clear()
+        
+        # Smooth gradient, so that a crop from the reduced image can be compared with a full-size crop
+        y, x = np.mgrid[0:1200, 0:1600]
+        pixels = np.dstack([x * 255 // 1600, y * 255 // 1200, np.full_like(x, 128)]).astype(np.uint8)
+        large_image_path = os.path.join(self.temp_dir.name, "large_image.jpg")
+        Image.fromarray(pixels).save(large_image_path, quality=95)
+        
+        # bbox_size + 2 * padding is 6 times cropped_size, so the JPEG is decoded at 1/4 size
+        original_draft = JpegImagePlugin.JpegImageFile.draft
+        with patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True, 
+                          side_effect=original_draft) as mock_draft:
+            result = process_image(large_image_path, "Test Name", 400, 100, (100, 160), 16, None,
+                                   0, "#000000", True, 10, 95, face_location=(500, 900, 900, 500))
+        mock_draft.assert_called_once()
+        self.assertEqual(mock_draft.call_args.args[2], (267, 200))
+        
+        # The precomputed location is used, scaled to the reduced image
+        mock_get_face_location.assert_not_called()
+        
+        # The picture matches a crop of the full-size image around the face
+        expected = cv2.resize(pixels[400:1000, 400:1000], (100, 100), interpolation=cv2.INTER_AREA)
+        output = np.asarray(Image.open(result))[10:110, 0:100]
+        self.assertLess(np.abs(output.astype(int) - expected.astype(int)).mean(), 3)
+        
+        # Without a precomputed location and with the HOG detector, the decoded image keeps
+        # at least DETECTION_MAX_SIZE pixels on the long side for detection
+        mock_get_face_location.return_value = (100, 300, 300, 100)
+        with patch('app.get_face_detector', return_value=None):
+            result = process_image(large_image_path, "Test Name", 200, 100, (100, 160), 16, None,
+                                   0, "#000000", True, 10, 95)
+        self.assertIsInstance(result, io.BytesIO)
+        self.assertEqual(mock_get_face_location.call_args.args[0].shape, (600, 800, 3))
+        
+        # With the DNN detector the image is reduced for the crop alone
+        with patch('app.get_face_detector', return_value=MagicMock()):
+            process_image(large_image_path, "Test Name", 200, 100, (100, 160), 16, None,
+                          0, "#000000", True, 10, 95)
+        self.assertEqual(mock_get_face_location.call_args.args[0].shape, (300, 400, 3))
+    
+    @patch('app.ImageFont')
+    def test_load_font(self, mock_image_font):
+        """Test that load_font parses each font only once."""
+        load_font.cache_clear()
+        
+        # Repeated calls with the same font and size reuse the loaded font
+        font = load_font("font.ttf", 16)
+        self.assertIs(load_font("font.ttf", 16), font)
+        mock_image_font.truetype.assert_called_once_with("font.ttf", 16)
+        
+        # Missing font path or unreadable font falls back to the default font
+        self.assertIs(load_font(None, 16), mock_image_font.load_default.return_value)
+        mock_image_font.truetype.side_effect = IOError
+        self.assertIs(load_font("missing.ttf", 16), mock_image_font.load_default.return_value)
+        
+        load_font.cache_clear()
+    
+    def test_get_wrapped_text(self):
+        """Test the get_wrapped_text function."""
+        # Mock a font where every character is 10 pixels wide
+        mock_font = MagicMock()
+        mock_font.getlength.side_effect = lambda text: 10 * len(text)
+        
+        # Words are wrapped once a line would exceed the max width
+        result = get_wrapped_text("John Jacob Smith", mock_font, 110)
+        self.assertEqual(result, ("John Jacob", "Smith"))
+        
+        # A single long word is kept on its own line
+        result = get_wrapped_text("Alexandria", mock_font, 50)
+        self.assertEqual(result, ("Alexandria",))
+        
+        # Each word is measured once, and repeated calls are served from the cache
+        mock_font.getlength.reset_mock()
+        get_wrapped_text("Jane Ann Doe", mock_font, 80)
+        get_wrapped_text("Jane Ann Doe", mock_font, 80)
+        self.assertEqual(mock_font.getlength.call_count, 4)  # space + 3 words
+    
+    def test_encode_jpeg(self):
+        """Test the encode_jpeg function."""
+        img = Image.new('RGB', (100, 160), color='white')
+        
+        # Pillow fallback produces a readable JPEG
+        with patch('app.turbo_jpeg', None):
+            result = encode_jpeg(img, 90)
+        self.assertIsInstance(result, io.BytesIO)
+        self.assertEqual(Image.open(result).format, 'JPEG')
+        
+        # libjpeg-turbo is used when available
+        with patch('app.turbo_jpeg') as mock_turbo_jpeg, \
+                patch('app.TJPF_RGB', 0, create=True), patch('app.TJSAMP_420', 2, create=True):
+            mock_turbo_jpeg.encode.return_value = b'jpeg'
+            result = encode_jpeg(img, 90)
+        self.assertEqual(result.getvalue(), b'jpeg')
+        self.assertEqual(mock_turbo_jpeg.encode.call_args.kwargs['quality'], 90)
+    
+    @patch('app.get_face_location')
+    def test_process_job(self, mock_get_face_location):
+        """Test that process_job reports errors instead of raising them."""
+        params = (40, 20, (100, 160), 16, None, 0, "#000000", True, 10, 90)
+        
+        # No face detected: no image and no error
+        mock_get_face_location.return_value = None
+        result, error = process_job((self.test_image_path, "Test Name", params, None))
+        self.assertIsNone(result)
+        self.assertIsNone(error)
+        
+        # Failure during processing: error message is returned
+        mock_get_face_location.side_effect = RuntimeError("boom")
+        result, error = process_job((self.test_image_path, "Test Name", params, None))
+        self.assertIsNone(result)
+        self.assertIn("test_image.jpg", error)
+        self.assertIn("boom", error)
+    
+    def test_extract_zip(self):
+        """Test the extract_zip function."""
+        with open(self.test_zip_path, 'rb') as f:
+            zip_bytes = f.read()
+        
+        temp_dir, csv_files, image_files = extract_zip(zip_bytes)
+        try:
+            # Check that the CSV and image files were found in the extracted directory
+            self.assertEqual([path.name for path in csv_files], ["names.csv"])
+            self.assertEqual([path.name for path in image_files], ["1.jpg"])
+            self.assertTrue(all(path.exists() for path in csv_files + image_files))
+            
+            # The same upload is not extracted again
+            self.assertIs(extract_zip(zip_bytes)[0], temp_dir)
+            
+            # It is extracted again if the directory has been removed
+            temp_dir.cleanup()
+            temp_dir, csv_files, image_files = extract_zip(zip_bytes)
+            self.assertTrue(all(path.exists() for path in csv_files + image_files))
+        finally:
+            extract_zip.clear()
+            temp_dir.cleanup()
+    
+    def test_save_font(self):
+        """Test the save_font function."""
+        font_path = save_font(b"font data", ".ttf")
+        try:
+            # The font is saved to a file named after its contents
+            self.assertTrue(font_path.endswith(".ttf"))
+            with open(font_path, 'rb') as f:
+                self.assertEqual(f.read(), b"font data")
+            self.assertEqual(save_font(b"font data", ".ttf"), font_path)
+            
+            # A different font gets its own file
+            other_font_path = save_font(b"other font data", ".ttf")
+            self.assertNotEqual(other_font_path, font_path)
+            os.remove(other_font_path)
+        finally:
+            os.remove(font_path)
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file